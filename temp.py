@@ -1,21 +1,37 @@
 import os
 import logging
-import random
-import string
-from datetime import datetime, timedelta
+import secrets
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 from telegram import Update
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from imap_tools import MailBox
-import requests
+from imap_tools import MailBox, AND
+from imap_tools.errors import ImapToolsError
+import imaplib
+import aiohttp
+import asyncio
+import json
 from email.utils import parseaddr
 import re
 
 # Load environment variables
 load_dotenv()
 
+DOMAIN = (os.getenv("DOMAIN") or "").lower()
+EMAIL_USER = os.getenv("EMAIL_USER")
+CLOUDFLARE_ZONE_ID = os.getenv("CLOUDFLARE_ZONE_ID")
+CLOUDFLARE_API_TOKEN = os.getenv("CLOUDFLARE_API_TOKEN")
+
+CLOUDFLARE_RULES_URL = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/email/routing/rules"
+CLOUDFLARE_HEADERS = {
+    "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
+    "Content-Type": "application/json"
+}
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,99 +44,243 @@ client = MongoClient(os.getenv("MONGODB_URL"))
 db = client.temp_mail_db
 users = db.users
 
+# Indexes backing the hot lookups: recipient resolution in check_emails,
+# per-user updates and the expiry sweep
+users.create_index("emails.address", background=True)
+users.create_index("user_id", unique=True, background=True)
+users.create_index("emails.expiry", background=True)
+
+# One document per active address; Mongo's TTL monitor deletes it at expiry
+# and the bot reacts to the delete through a change stream
+expirations = db.expirations
+expirations.create_index("expiry", expireAfterSeconds=0)
+
+# How long past expiry the sweep waits before taking over an address the
+# change stream should already have handled
+EXPIRY_SWEEP_GRACE = timedelta(hours=1)
+
+# Maximum operations sent per bulk_write
+BULK_WRITE_BATCH = 1000
+
+# Broadcast messages started per second, under Telegram's ~30/s global limit
+BROADCAST_RATE = 25
+
+# Broadcast sends kept in flight at once
+BROADCAST_WORKERS = 25
+
+# Re-enter IMAP IDLE well before NATs and firewalls drop an idle connection
+# (Gmail's own cutoff is ~30 minutes)
+IMAP_IDLE_TIMEOUT = 5 * 60
+
+# Socket timeout for IMAP commands, so a dead connection raises instead of
+# blocking forever; idle.wait() swaps in its own timeout while polling
+IMAP_SOCKET_TIMEOUT = 60
+
+# Characters that must be escaped in Telegram MarkdownV2
+MDV2_ESCAPE = re.compile(r'([\_\*\[\]\(\)\~\`\>#\+\-=\|{}\.!])')
+
+# Cloudflare retry policy: exponential back-off, honouring Retry-After
+CLOUDFLARE_RETRIES = 5
+CLOUDFLARE_BACKOFF = 0.5
+CLOUDFLARE_MAX_DELAY = 60
+# /genemail waits on the POST, so keep its worst case to well under a minute
+CLOUDFLARE_POST_RETRIES = 2
+CLOUDFLARE_POST_MAX_DELAY = 5
+CLOUDFLARE_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 class CloudflareManager:
     @staticmethod
-    def create_email_rule(email):
+    async def _request(session, method, url, retries=CLOUDFLARE_RETRIES,
+                       max_delay=CLOUDFLARE_MAX_DELAY, **kwargs):
+        # A POST that reached the server may have been applied, so only retry
+        # it when it was rejected (429) or never sent; other methods are idempotent
+        idempotent = method != "POST"
+        retry_statuses = CLOUDFLARE_RETRY_STATUSES if idempotent else {429}
+        retry_errors = (
+            (aiohttp.ClientError, asyncio.TimeoutError) if idempotent
+            else aiohttp.ClientConnectorError
+        )
+        for attempt in range(retries + 1):
+            delay = min(CLOUDFLARE_BACKOFF * 2 ** attempt, max_delay)
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    if response.status not in retry_statuses or attempt == retries:
+                        return response.status, await response.text()
+                    try:
+                        delay = min(float(response.headers.get('Retry-After', delay)), max_delay)
+                    except ValueError:
+                        pass
+                    logger.warning(f"Cloudflare {method} returned {response.status}, retrying in {delay}s")
+            except retry_errors as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Cloudflare {method} failed: {e}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def create_email_rule(session, email):
         try:
-            response = requests.post(
-                f"https://api.cloudflare.com/client/v4/zones/{os.getenv('CLOUDFLARE_ZONE_ID')}/email/routing/rules",
-                headers={
-                    "Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}",
-                    "Content-Type": "application/json"
-                },
+            status, text = await CloudflareManager._request(
+                session, "POST", CLOUDFLARE_RULES_URL,
+                retries=CLOUDFLARE_POST_RETRIES,
+                max_delay=CLOUDFLARE_POST_MAX_DELAY,
                 json={
                     "actions": [{
                         "type": "forward",
-                        "value": [os.getenv("EMAIL_USER")]
+                        "value": [EMAIL_USER]
                     }],
                     "matchers": [{
                         "type": "literal",
                         "field": "to",
                         "value": email
                     }]
-                },
-                timeout=10
+                }
             )
-            logger.info(f"Cloudflare API Response: {response.status_code} - {response.text}")
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            logger.info(f"Cloudflare API Response: {status} - {text}")
+            return json.loads(text)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"Cloudflare API Error: {str(e)}")
             return {"success": False, "errors": [{"message": str(e)}]}
 
     @staticmethod
-    def delete_email_rule(rule_id):
+    async def delete_email_rule(session, rule_id):
         try:
-            response = requests.delete(
-                f"https://api.cloudflare.com/client/v4/zones/{os.getenv('CLOUDFLARE_ZONE_ID')}/email/routing/rules/{rule_id}",
-                headers={
-                    "Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}",
-                    "Content-Type": "application/json"
-                },
-                timeout=10
+            _, text = await CloudflareManager._request(
+                session, "DELETE", f"{CLOUDFLARE_RULES_URL}/{rule_id}"
             )
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return json.loads(text)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"Cloudflare Delete Error: {str(e)}")
             return {"success": False}
 
+    @staticmethod
+    async def iter_email_rules(session, per_page=50):
+        page = 1
+        while True:
+            try:
+                _, text = await CloudflareManager._request(
+                    session, "GET", CLOUDFLARE_RULES_URL,
+                    params={"page": page, "per_page": per_page}
+                )
+                data = json.loads(text)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"Cloudflare List Error: {str(e)}")
+                return
+            if not data.get('success'):
+                logger.error(f"Cloudflare List Error: {data.get('errors')}")
+                return
+            for rule in data['result']:
+                yield rule
+            if len(data['result']) < per_page:
+                return
+            page += 1
+
 class EmailHandler:
     @staticmethod
-    async def check_emails(context: ContextTypes.DEFAULT_TYPE):
+    async def check_emails(bot, mailbox):
         logger.info("Checking emails...")
+        # Route on headers, peeked so undelivered mail stays unseen; IMAP
+        # blocks, so fetch in a worker thread
+        headers = await asyncio.to_thread(lambda: list(mailbox.fetch(
+            AND(seen=False), mark_seen=False, headers_only=True, bulk=True
+        )))
+        logger.info(f"Fetched {len(headers)} new emails")
+
+        # Resolve every recipient with a single query instead of one per message
+        pairs = [
+            (msg.uid, parseaddr(addr)[1].lower())
+            for msg in headers
+            for addr in msg.to
+        ]
+        owners = {}
+        if pairs:
+            cursor = users.find(
+                {"emails.address": {"$in": list({to_email for _, to_email in pairs})}},
+                {"user_id": 1, "emails.address": 1, "_id": 0}
+            )
+            for user in cursor:
+                for e in user.get('emails', []):
+                    owners[e['address']] = user['user_id']
+
+        routes = {}
+        for uid, to_email in pairs:
+            logger.info(f"Processing email to: {to_email}")
+            if uid not in routes and to_email in owners:
+                routes[uid] = (to_email, owners[to_email])
+        if not routes:
+            return
+
+        # Download full bodies only for routable messages, in one FETCH
+        uids_to_delete = []
         try:
-            with MailBox('imap.gmail.com').login(
-                os.getenv("EMAIL_USER"),
-                os.getenv("EMAIL_PASSWORD")
-            ) as mailbox:
-                logger.info("IMAP login successful")
-                messages = list(mailbox.fetch('ALL', mark_seen=False))
-                logger.info(f"Fetched {len(messages)} emails")
-                for msg in messages:
-                    to_emails = [parseaddr(addr)[1].lower() for addr in msg.to]
-                    for to_email in to_emails:
-                        logger.info(f"Processing email to: {to_email}")
-                        user = users.find_one({"emails.address": to_email})
-                        logger.info(f"User found: {user}")
-                        if user:
-                            clean_text = EmailHandler.sanitize_content(msg.text or "")
-                            email_content = (
-                                f"📨 New Email: {to_email}\n"
-                                f"From: {msg.from_}\n"
-                                f"Subject: {msg.subject}\n\n"
-                                f"{clean_text}"
-                            )
-                            if len(email_content) > 4000:
-                                email_content = email_content[:4000] + "\n... [truncated]"
-                            logger.info(f"Sending to {user['user_id']}...")
-                            await context.bot.send_message(
-                                chat_id=user['user_id'],
-                                text=email_content
-                            )
-                            mailbox.delete(msg.uid)
-                            logger.info(f"Deleted email UID: {msg.uid}")
-                            break
-        except Exception as e:
-            logger.error(f"IMAP error: {e}")
+            messages = await asyncio.to_thread(lambda: list(mailbox.fetch(
+                AND(uid=list(routes)), mark_seen=False, bulk=True
+            )))
+            for msg in messages:
+                to_email, user_id = routes[msg.uid]
+                clean_text = EmailHandler.sanitize_content(msg.text or "")
+                email_content = (
+                    f"📨 New Email: {to_email}\n"
+                    f"From: {msg.from_}\n"
+                    f"Subject: {msg.subject}\n\n"
+                    f"{clean_text}"
+                )
+                if len(email_content) > 4000:
+                    email_content = email_content[:4000] + "\n... [truncated]"
+                logger.info(f"Sending to {user_id}...")
+                try:
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=email_content
+                    )
+                except Exception as e:
+                    # Leave the message in the inbox so the next check retries it
+                    logger.error(f"Delivery failed for {user_id}: {e}")
+                    continue
+                uids_to_delete.append(msg.uid)
+        finally:
+            if uids_to_delete:
+                await asyncio.to_thread(mailbox.delete, uids_to_delete)
+                logger.info(f"Deleted email UIDs: {', '.join(uids_to_delete)}")
 
     @staticmethod
     def sanitize_content(text):
-        text = re.sub(r'([\_\*\[\]\(\)\~\`\>#\+\-=\|{}\.!])', r'\\\1', text)
+        text = MDV2_ESCAPE.sub(r'\\\1', text)
+        # isascii() is O(1) on CPython, so most mail skips the re-encode
+        if text.isascii():
+            return text
         return text.encode('ascii', 'ignore').decode()
 
 class TempMailBot:
     def __init__(self):
+        # Validate environment once, before the bot or its background tasks start
+        required_vars = [
+            'TELEGRAM_BOT_TOKEN', 'CLOUDFLARE_API_TOKEN', 'CLOUDFLARE_ZONE_ID',
+            'DOMAIN', 'EMAIL_USER', 'EMAIL_PASSWORD'
+        ]
+        if missing := [var for var in required_vars if not os.getenv(var)]:
+            logger.error(f"Missing variables: {', '.join(missing)}")
+            raise RuntimeError(f"Missing variables: {', '.join(missing)}")
+
         self.scheduler = AsyncIOScheduler()
-        self.app = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+        self.http = None
+        self._idle_task = None
+        self._expiry_task = None
+        self._expiry_resume_token = None
+        # Set when the expiry change stream is unavailable and the hourly
+        # sweep has to expire every address itself
+        self._sweep_all = False
+        self._mailbox = None
+        self.app = (
+            Application.builder()
+            .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            # A slow Cloudflare call in one /genemail must not hold up
+            # every other user's commands
+            .concurrent_updates(True)
+            .build()
+        )
         self._register_handlers()
         self._schedule_tasks()
 
@@ -132,11 +292,150 @@ class TempMailBot:
 
     def _schedule_tasks(self):
         self.scheduler.add_job(self._delete_expired_emails, 'interval', hours=1)
-        self.scheduler.add_job(
-            EmailHandler.check_emails,
-            'interval',
-            seconds=int(os.getenv("CHECK_INTERVAL", 120)),
-            args=[self.app]
+
+    async def _post_init(self, application: Application):
+        # One shared session so Cloudflare calls reuse connections; it has to be
+        # created inside the running event loop
+        self.http = aiohttp.ClientSession(
+            headers=CLOUDFLARE_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(
+                limit=64,
+                limit_per_host=64,
+                keepalive_timeout=75,
+                ttl_dns_cache=300
+            )
+        )
+
+        self._idle_task = asyncio.create_task(self._idle_loop())
+        self._expiry_task = asyncio.create_task(self._expiry_loop())
+
+    async def _post_shutdown(self, application: Application):
+        for task in (self._idle_task, self._expiry_task):
+            if task:
+                task.cancel()
+        if self.http:
+            await self.http.close()
+
+    def _get_mailbox(self):
+        # One logged-in connection per process, reused until it fails
+        if self._mailbox is not None:
+            try:
+                self._mailbox.folder.status()
+                return self._mailbox
+            except Exception as e:
+                logger.warning(f"IMAP connection lost: {e}")
+                self._drop_mailbox()
+
+        self._mailbox = MailBox('imap.gmail.com', timeout=IMAP_SOCKET_TIMEOUT).login(
+            EMAIL_USER,
+            os.getenv("EMAIL_PASSWORD")
+        )
+        logger.info("IMAP login successful")
+        return self._mailbox
+
+    def _drop_mailbox(self):
+        # Only called for connections that are broken or being abandoned, so
+        # close the socket rather than send LOGOUT; this never blocks
+        mailbox, self._mailbox = self._mailbox, None
+        if mailbox is not None:
+            try:
+                mailbox.client.shutdown()
+            except Exception:
+                pass
+
+    async def _idle_loop(self):
+        # Keep one IMAP connection parked in IDLE so Gmail pushes new mail
+        # instead of us logging in on every poll
+        backoff = 1
+        while True:
+            try:
+                mailbox = await asyncio.to_thread(self._get_mailbox)
+                backoff = 1
+                # Pick up anything that arrived while we were disconnected
+                await EmailHandler.check_emails(self.app.bot, mailbox)
+                while True:
+                    # Leave and re-enter IDLE periodically to keep the connection
+                    # alive. Check after every return, timeouts included: an EXISTS sent
+                    # while we were fetching never reaches IDLE, and an UNSEEN
+                    # search is cheap
+                    await asyncio.to_thread(mailbox.idle.wait, timeout=IMAP_IDLE_TIMEOUT)
+                    await EmailHandler.check_emails(self.app.bot, mailbox)
+            except asyncio.CancelledError:
+                # Also unblocks the thread still waiting in IDLE
+                self._drop_mailbox()
+                raise
+            except (imaplib.IMAP4.error, ImapToolsError, OSError) as e:
+                logger.error(f"IMAP error: {e}, reconnecting in {backoff}s")
+                self._drop_mailbox()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300)
+            except Exception as e:
+                # Not an IMAP failure (e.g. Mongo), so keep the connection;
+                # _get_mailbox() probes it before it is reused
+                logger.error(f"Email check failed: {e}, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300)
+
+    def _watch_expirations(self):
+        return expirations.watch(
+            [{"$match": {"operationType": "delete"}}],
+            full_document_before_change="required",
+            resume_after=self._expiry_resume_token
+        )
+
+    def _disable_expiry_stream(self, e):
+        logger.warning(f"Expiry change stream unavailable, relying on hourly sweep: {e}")
+        self._sweep_all = True
+
+    async def _expiry_loop(self):
+        backoff = 1
+        prepared = False
+        while True:
+            try:
+                if not prepared:
+                    # TTL deletes carry no payload, so the deleted document has
+                    # to come from the change stream pre-image
+                    try:
+                        await asyncio.to_thread(
+                            db.command, "collMod", "expirations",
+                            changeStreamPreAndPostImages={"enabled": True}
+                        )
+                    except OperationFailure as e:
+                        return self._disable_expiry_stream(e)
+                    prepared = True
+
+                stream = await asyncio.to_thread(self._watch_expirations)
+                with stream:
+                    backoff = 1
+                    while stream.alive:
+                        change = await asyncio.to_thread(stream.try_next)
+                        if change is not None:
+                            await self._expire_email(change['fullDocumentBeforeChange'])
+                        self._expiry_resume_token = stream.resume_token
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 40573: change streams need a replica set
+                if isinstance(e, OperationFailure) and e.code == 40573:
+                    return self._disable_expiry_stream(e)
+                if isinstance(e, OperationFailure):
+                    # PyMongo resumes resumable errors itself, so this one (lost
+                    # history, missing pre-image, ...) would recur with the same
+                    # token. Start from now; the hourly sweep picks up anything
+                    # expired in between once it is past the grace period
+                    self._expiry_resume_token = None
+                logger.error(f"Expiry change stream error: {e}, reconnecting in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300)
+
+    async def _expire_email(self, doc):
+        logger.info(f"Expiring email: {doc['address']}")
+        if rule_id := doc.get('rule_id'):
+            await CloudflareManager.delete_email_rule(self.http, rule_id)
+        users.update_one(
+            {"user_id": doc['user_id']},
+            {"$pull": {"emails": {"address": doc['address']}}}
         )
 
     async def _start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -147,29 +446,31 @@ class TempMailBot:
         )
 
     async def _generate_email(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        # Validate environment
-        required_vars = ['CLOUDFLARE_API_TOKEN', 'CLOUDFLARE_ZONE_ID', 'DOMAIN', 'EMAIL_USER']
-        if missing := [var for var in required_vars if not os.getenv(var)]:
-            logger.error(f"Missing variables: {', '.join(missing)}")
-            await update.message.reply_text("⚠️ Service temporarily unavailable")
-            return
-
         user_id = update.effective_user.id
-        email = f"{''.join(random.choices(string.ascii_lowercase + string.digits, k=10))}@{os.getenv('DOMAIN')}".lower()
+        email = f"{secrets.token_hex(6)}@{DOMAIN}"
         logger.info(f"Generating email: {email}")  # Log the generated email
 
-        response = CloudflareManager.create_email_rule(email)
+        response = await CloudflareManager.create_email_rule(self.http, email)
 
         if response.get('success'):
+            rule_id = response['result']['id']
             users.update_one(
                 {"user_id": user_id},
                 {"$push": {"emails": {
                     "address": email,
                     "expiry": datetime.now() + timedelta(days=1),
-                    "created": datetime.now()
+                    "created": datetime.now(),
+                    "rule_id": rule_id
                 }}},
                 upsert=True
             )
+            # TTL indexes compare against UTC, so this expiry is timezone-aware
+            expirations.insert_one({
+                "expiry": datetime.now(timezone.utc) + timedelta(days=1),
+                "user_id": user_id,
+                "address": email,
+                "rule_id": rule_id
+            })
             await update.message.reply_text(
                 f"✅ Temporary Email Created\n\n"
                 f"📧 `{email}`\n"
@@ -185,7 +486,10 @@ class TempMailBot:
             await update.message.reply_text(error_msg)
 
     async def _list_emails(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = users.find_one({"user_id": update.effective_user.id})
+        user = users.find_one(
+            {"user_id": update.effective_user.id},
+            {"emails.address": 1, "emails.expiry": 1, "_id": 0}
+        )
         if not user or not user.get('emails'):
             return await update.message.reply_text("❌ No active emails found")
 
@@ -203,41 +507,128 @@ class TempMailBot:
         if not message:
             return await update.message.reply_text("Usage: /broadcast <message>")
 
-        sent = 0
-        for user_id in users.distinct("user_id"):
-            try:
-                await context.bot.send_message(user_id, f"📢 Admin Message:\n\n{message}")
-                sent += 1
-            except Exception as e:
-                logger.error(f"Broadcast failed for {user_id}: {e}")
+        # Start at most BROADCAST_RATE sends per second so we stay under
+        # Telegram's global flood limit
+        pacing = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+
+        async def _wait_turn():
+            nonlocal next_send
+            async with pacing:
+                if (delay := next_send - loop.time()) > 0:
+                    await asyncio.sleep(delay)
+                next_send = max(next_send, loop.time()) + 1 / BROADCAST_RATE
+
+        async def _send_one(user_id):
+            nonlocal next_send
+            for _ in range(3):
+                await _wait_turn()
+                try:
+                    await context.bot.send_message(user_id, f"📢 Admin Message:\n\n{message}")
+                    return 1
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot, so pause every sender
+                    logger.warning(f"Broadcast rate limited, retrying in {e.retry_after}s")
+                    next_send = max(next_send, loop.time() + e.retry_after)
+                except Exception as e:
+                    logger.error(f"Broadcast failed for {user_id}: {e}")
+                    return 0
+            logger.error(f"Broadcast failed for {user_id}: rate limited")
+            return 0
+
+        # A fixed pool of workers pulls ids off one cursor, so users are
+        # streamed in batches rather than materialised up front
+        cursor = users.find({}, {"user_id": 1, "_id": 0}).batch_size(1000)
+
+        async def _worker():
+            delivered = 0
+            for doc in cursor:
+                delivered += await _send_one(doc['user_id'])
+            return delivered
+
+        sent = sum(await asyncio.gather(*[_worker() for _ in range(BROADCAST_WORKERS)]))
 
         await update.message.reply_text(f"Broadcast delivered to {sent} users")
 
     async def _delete_expired_emails(self):
         now = datetime.now()
-        expired_users = users.aggregate([
-            {"$unwind": "$emails"},
-            {"$match": {"emails.expiry": {"$lte": now}}}
+        if self._sweep_all:
+            expired = {"expiry": {"$lte": now}}
+            cond = {"$lte": ["$$this.expiry", now]}
+        else:
+            # The change stream expires addresses that have a rule id within a
+            # minute or so; the sweep only covers older entries without one and
+            # anything the stream missed while the bot was down
+            stale = now - EXPIRY_SWEEP_GRACE
+            expired = {"$or": [
+                {"expiry": {"$lte": now}, "rule_id": {"$exists": False}},
+                {"expiry": {"$lte": stale}}
+            ]}
+            cond = {"$or": [
+                {"$and": [
+                    {"$lte": ["$$this.expiry", now]},
+                    {"$eq": [{"$type": "$$this.rule_id"}, "missing"]}
+                ]},
+                {"$lte": ["$$this.expiry", stale]}
+            ]}
+
+        # $match first so the emails.expiry index prunes users, then return only
+        # the expired sub-documents of each matching user
+        expired_users = list(users.aggregate([
+            {"$match": {"emails": {"$elemMatch": expired}}},
+            {"$project": {
+                "_id": 0,
+                "user_id": 1,
+                "expired": {"$filter": {"input": "$emails", "cond": cond}}
+            }}
+        ]))
+        if not expired_users:
+            return
+
+        rule_map = {
+            e['address']: e['rule_id']
+            for doc in expired_users
+            for e in doc['expired']
+            if e.get('rule_id')
+        }
+
+        # Addresses created before rule ids were stored still have to be
+        # looked up; page through the rules only until all of them are found
+        pending = {
+            e['address']
+            for doc in expired_users
+            for e in doc['expired']
+            if not e.get('rule_id')
+        }
+        if pending:
+            async for rule in CloudflareManager.iter_email_rules(self.http):
+                for matcher in rule.get('matchers', []):
+                    if matcher.get('value') in pending:
+                        rule_map[matcher['value']] = rule['id']
+                        pending.discard(matcher['value'])
+                if not pending:
+                    break
+
+        # Delete Cloudflare rules
+        await asyncio.gather(*[
+            CloudflareManager.delete_email_rule(self.http, rule_id)
+            for rule_id in rule_map.values()
         ])
 
+        # Remove from database; updates touch different users, so they can be
+        # applied unordered in batches
+        ops = []
         for doc in expired_users:
-            email = doc['emails']['address']
-            # Delete Cloudflare rule
-            rules = requests.get(
-                f"https://api.cloudflare.com/client/v4/zones/{os.getenv('CLOUDFLARE_ZONE_ID')}/email/routing/rules",
-                headers={"Authorization": f"Bearer {os.getenv('CLOUDFLARE_API_TOKEN')}"}
-            ).json()
-
-            if rules.get('success'):
-                for rule in rules['result']:
-                    if email in rule['matchers'][0]['value']:
-                        CloudflareManager.delete_email_rule(rule['id'])
-
-            # Remove from database
-            users.update_one(
+            ops.append(UpdateOne(
                 {"user_id": doc['user_id']},
-                {"$pull": {"emails": {"address": email}}}
-            )
+                {"$pull": {"emails": expired}}
+            ))
+            if len(ops) == BULK_WRITE_BATCH:
+                users.bulk_write(ops, ordered=False)
+                ops.clear()
+        if ops:
+            users.bulk_write(ops, ordered=False)
 
     def run(self):
         self.scheduler.start()